@@ -11,20 +11,34 @@ Last Updated: 7/19/2024
 
 import os
 import sys
+import argparse
 from pathlib import Path
 import requests
 import json
 import folium
+from folium.plugins import FastMarkerCluster
 import base64
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+try:
+    # SIMD accelerated drop in for base64, if installed
+    import pybase64 as base64
+except ImportError:
+    pass
+try:
+    # Faster DataFrame materialization over the SQLite file, if installed
+    import duckdb
+except ImportError:
+    duckdb = None
 import numpy as np
 import geopandas as gpd
 import pandas as pd
 import matplotlib.pyplot as plt
 import io
-from PIL import Image
+from PIL import Image, ImageFile, ImageOps
 import sqlite3
 from shapely.geometry import Point
-from sqlalchemy import create_engine
 
 
 #####################################################################################################################
@@ -54,38 +68,164 @@ DB_FOLDER_PATH = current_dir / "data"
 PATH_TO_DB = str(DB_FOLDER_PATH / DATABASE)
 print(f"Path to DB: {PATH_TO_DB}")
 TABLE_NAME = 'measurements'
+THUMBNAIL_SIZE = (150, 100)
+# Bump when map or thumbnail output changes so cached maps are re-rendered
+MAP_CACHE_VERSION = 1
+# Below this many photos a process pool costs more to start than it saves
+POOL_MIN_IMAGES = 16
+
+# Bound html templates for popup images
+EMBEDDED_IMAGE_HTML = '<img src="data:image/jpeg;base64,{}" width="150" height="100">'.format
+LINKED_IMAGE_HTML = '<img src="{}" width="150" height="100" loading="lazy">'.format
+
+# Builds each clustered marker client side from a [lat, lon, popup_html] row
+POPUP_MARKER_CALLBACK = """
+function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    marker.bindPopup(row[2]);
+    return marker;
+};
+"""
+
+# Don't fail on partially uploaded photos
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+#####################################################################################################################
+## Functions
+#####################################################################################################################
+
+def make_thumbnail(image_blob):
+    """
+    Downscale an image BLOB to popup size JPEG bytes.
+    """
+    try:
+        img = Image.open(io.BytesIO(image_blob))
+        # Re-encoding drops EXIF, so apply its orientation first
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail(THUMBNAIL_SIZE)
+        buf = io.BytesIO()
+        img.convert('RGB').save(buf, format='JPEG', quality=75, optimize=True)
+        return buf.getvalue()
+
+    except Exception as e:
+        print('Error creating thumbnail, using original image.', e)
+        return image_blob
+
+def encode_image(args):
+    """
+    Thumbnail one (key, image_blob, embed) job, base64 encoding it if embed is set.
+    Module level so it can run in a process pool.
+    """
+    key, image_blob, embed = args
+    thumb = make_thumbnail(image_blob)
+    if embed:
+        return key, base64.b64encode(thumb)
+    return key, thumb
 
 #####################################################################################################################
 ## Classes
 #####################################################################################################################
 
 class leakMapper():
-    def __init__(self, path_to_db, table_name, city):
+    def __init__(self, path_to_db, table_name, city, build_gdf=False, embed_images=False, max_workers=None):
         self.conn = None
+        self.index_checked = False
+        self.duck = None
+        self.duck_enabled = duckdb is not None
         self.path_to_db = path_to_db
         self.table = table_name
         self.city = city
-        self.engine = create_engine(f'sqlite:///{path_to_db}')
         self.df = None
         self.gdf = None
+        self.build_gdf = build_gdf
         self.map = None
         self.map_name = f"{city}_maine_map.html"
-        self.imgdf = pd.read_sql_table('photos', self.engine)
+        self.imgdf = None
+        self.img_cache = {}
+        self.embed_images = embed_images
+        self.max_workers = max_workers
+        self.photo_dir = Path(self.map_name).parent / 'photos'
+        self.cache_path = f"{self.map_name}.cache"
 
     def connect(self):
         if self.conn is None:
-            self.conn = sqlite3.connect(self.path_to_db)
+            self.conn = sqlite3.connect(self.path_to_db, isolation_level=None)
+
+            # Tune for read heavy use
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("PRAGMA mmap_size=268435456")
+            self.conn.execute("PRAGMA cache_size=-65536")
+            self.conn.execute("PRAGMA temp_store=MEMORY")
+
+            # Index city on first connect; a read only or locked DB can still be mapped without it
+            if not self.index_checked:
+                self.index_checked = True
+                try:
+                    self.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.table}_city ON {self.table}(city)")
+                except sqlite3.Error as e:
+                    print(f"Could not create city index on {self.table}, continuing without it.", e)
 
     def close_connection(self):
         if self.conn is not None:
             self.conn.close()
             self.conn = None
+        if self.duck is not None:
+            self.duck.close()
+            self.duck = None
+
+    def connect_duckdb(self):
+        """
+        Attach the DB in DuckDB. Falls back to sqlite3 for good if this fails (e.g. no network for INSTALL).
+        """
+        if self.duck is not None:
+            return
+        try:
+            self.duck = duckdb.connect()
+            self.duck.execute("INSTALL sqlite; LOAD sqlite;")
+            path = str(self.path_to_db).replace("'", "''")
+            self.duck.execute(f"ATTACH '{path}' AS m (TYPE SQLITE, READ_ONLY)")
+            self.duck.execute("USE m")
+
+        except Exception as e:
+            print('Failed to set up DuckDB, reading with sqlite3 instead.', e)
+            if self.duck is not None:
+                self.duck.close()
+            self.duck = None
+            self.duck_enabled = False
+
+    def read_query(self, query, params=(), parse_dates=None):
+        """
+        Read a query into a DataFrame, through DuckDB if available, else the sqlite3 connection.
+        """
+        if self.duck_enabled:
+            self.connect_duckdb()
+
+        if self.duck_enabled:
+            try:
+                df = self.duck.execute(query, list(params)).df()
+                for col in parse_dates or []:
+                    df[col] = pd.to_datetime(df[col])
+                return df
+
+            except duckdb.Error as e:
+                print('DuckDB query failed, reading with sqlite3 instead.', e)
+                self.duck.close()
+                self.duck = None
+                self.duck_enabled = False
+
+        self.connect()
+        return pd.read_sql_query(query, self.conn, params=params, parse_dates=parse_dates)
 
     def set_df(self):
 
         try:
-            self.df = pd.read_sql_table(self.table, self.engine)
-            print(self.df)
+            self.connect()
+            self.df = self.read_measurements()
+            print(f"measurements: {self.df.shape}, dtypes: {self.df.dtypes.to_dict()}")
+
+            # Only load the photos these measurements reference
+            self.set_imgdf()
 
         except Exception as e:
             print('Error retrieving data from databse.', e)
@@ -94,6 +234,31 @@ class leakMapper():
             #self.close_connection()
             pass
 
+    def read_measurements(self):
+        """
+        Read the columns the map uses for this city.
+        """
+        # leak is cast in SQL since DuckDB reads the BOOL column as '0'/'1' strings; NULL counts as no leak
+        query = f"""
+                SELECT latitude, longitude, methane_level, timestamp, type_of_infrastructure, photo_id,
+                       CAST(COALESCE(leak, 0) AS INTEGER) AS leak
+                FROM {self.table}
+                WHERE city = ?
+                """
+        df = self.read_query(query, params=(self.city,), parse_dates=['timestamp'])
+        return df.astype({'leak': bool, 'methane_level': np.float32})
+
+    def set_imgdf(self):
+        """
+        Load image BLOBs for the photo_ids this city's measurements reference and cache them.
+        """
+        query = f"""
+                SELECT photo_id, photo FROM photos
+                WHERE photo_id IN (SELECT photo_id FROM {self.table} WHERE city = ?)
+                """
+        self.imgdf = self.read_query(query, params=(self.city,))
+        self.set_image_cache()
+
     def set_gdf(self):
 
         if self.df is None:
@@ -102,10 +267,11 @@ class leakMapper():
         
         try:
             #self.connect()
+            # Coordinate reference system (CRS) is WGS84 (EPSG:4326)
             self.gdf = gpd.GeoDataFrame(self.df, 
-                                    geometry=gpd.points_from_xy(self.df['longitude'], self.df['latitude'])
+                                    geometry=gpd.points_from_xy(self.df['longitude'], self.df['latitude'], crs='EPSG:4326')
                                     )
-            print(self.gdf)
+            print(f"geodataframe: {self.gdf.shape}, crs: {self.gdf.crs}")
 
         except Exception as e:
             print('Error creating GeoPandas dataframe.', e)
@@ -114,47 +280,93 @@ class leakMapper():
             #self.close_connection()
             pass
 
+    def set_image_cache(self):
+        """
+        Write a thumbnail of every image BLOB to photo_dir once, keyed by photo_id.
+        If embed_images is set, base64 encode them instead for a single file export.
+        Thumbnails are made in a process pool when there are enough photos; lower max_workers if large BLOBs
+        use too much memory, or set it to 1 to run serially.
+        """
+        # Identical BLOBs (reshoots, placeholders) are only processed once.
+        # Thumbnail settings are hashed in too, so a changed thumbnail gets a new file name.
+        digests = {}
+        blobs = {}
+        for photo_id, image_blob in zip(self.imgdf['photo_id'], self.imgdf['photo']):
+            hasher = hashlib.blake2b(f"{MAP_CACHE_VERSION}|{THUMBNAIL_SIZE}|".encode(), digest_size=16)
+            hasher.update(image_blob)
+            digest = hasher.hexdigest()
+            digests[photo_id] = digest
+            blobs.setdefault(digest, image_blob)
+
+        # Thumbnails already on disk from an earlier run are reused
+        if not self.embed_images:
+            os.makedirs(self.photo_dir, exist_ok=True)
+            blobs = {digest: image_blob for digest, image_blob in blobs.items()
+                     if not (self.photo_dir / f'{digest}.jpg').exists()}
+
+        jobs = zip(blobs.keys(), blobs.values(), repeat(self.embed_images))
+        if len(blobs) >= POOL_MIN_IMAGES and self.max_workers != 1:
+            # Spread the jobs over every worker, a few chunks each
+            workers = self.max_workers or os.cpu_count() or 1
+            chunksize = max(1, len(blobs) // (workers * 4))
+            with ProcessPoolExecutor(max_workers=self.max_workers) as ex:
+                images = dict(ex.map(encode_image, jobs, chunksize=chunksize))
+        else:
+            images = dict(map(encode_image, jobs))
+
+        if self.embed_images:
+            self.img_cache = {photo_id: images[digest] for photo_id, digest in digests.items()}
+            return
+
+        for digest, thumb in images.items():
+            with open(self.photo_dir / f'{digest}.jpg', 'wb') as f:
+                f.write(thumb)
+        self.img_cache = {photo_id: f'photos/{digest}.jpg' for photo_id, digest in digests.items()}
+
     def get_image(self, photo_id):
         """
-        Convert image BLOB to base64 string.
+        Build image html for photo_id from the cache.
         """
-        try:
-            image_blob = self.imgdf[self.imgdf['photo_id'] == photo_id]['photo'].values[0]
-            image_base64 = base64.b64encode(image_blob).decode('utf-8')
-            image_html = f'<img src="data:image/jpeg;base64,{image_base64}" width="150" height="100">'
-            return image_html
-        
-        except IndexError:
+        image = self.img_cache.get(photo_id)
+        if image is None:
             print(f"No matching image found for photo_id == {photo_id}")
             return "<p>No image available</p>"
+        if self.embed_images:
+            return EMBEDDED_IMAGE_HTML(image.decode("utf-8"))
+        return LINKED_IMAGE_HTML(image)
     
     def plot_popups(self):
 
-        if self.gdf is None:
-            print('GeoDataFrame is not set. Call set_gdf() first.')
+        if self.df is None:
+            print('DataFrame is not set. Call set_df() first.')
             return
 
-        # Set the coordinate reference system (CRS) to WGS84 (EPSG:4326)
-        self.gdf.set_crs(epsg=4326, inplace=True)
-
         # Convert any Timestamp columns to strings to avoid json serialization issues
-        for col in self.gdf.columns:
-            if pd.api.types.is_datetime64_any_dtype(self.gdf[col]):
-                self.gdf[col] = self.gdf[col].astype(str)
+        dt_cols = self.df.select_dtypes(include=['datetime', 'datetimetz']).columns
+        self.df[dt_cols] = self.df[dt_cols].astype(str)
 
+        # Drop any points without a location
+        valid = ~(self.df[['latitude', 'longitude']].isna().any(axis=1)).to_numpy()
+        df_valid = self.df[valid]
 
+        if df_valid.empty:
+            print(f"No measurements with a location for city {self.city}, map not saved.")
+            return
 
-        # Initialize a folium map centered around the first point
-        center = [self.gdf.geometry.y.mean(), self.gdf.geometry.x.mean()]
+        # Pull the columns we need out as arrays once
+        lats = df_valid['latitude'].to_numpy(dtype=float)
+        lons = df_valid['longitude'].to_numpy(dtype=float)
+        leak = df_valid['leak'].to_numpy()
+
+        # Initialize a folium map centered around the mean point
+        center = [lats.mean(), lons.mean()]
         self.map = folium.Map(location=center, 
                               zoom_start=13, 
                               control_scale=True,
                               max_bounds=True)
         
         # Calculate the bounds
-        min_lon, max_lon = self.gdf.geometry.x.min(), self.gdf.geometry.x.max()
-        min_lat, max_lat = self.gdf.geometry.y.min(), self.gdf.geometry.y.max()
-        bounds = [[min_lat, min_lon], [max_lat, max_lon]]
+        bounds = [[lats.min(), lons.min()], [lats.max(), lons.max()]]
 
         # Fit the map to these bounds
         self.map.fit_bounds(bounds)
@@ -164,30 +376,25 @@ class leakMapper():
         layer_nonzero = folium.FeatureGroup(name='Non Zero')
         layer_zero = folium.FeatureGroup(name='Zeros')
         
-        for idx, row in self.gdf.iterrows():
-            location = [row['latitude'], row['longitude']]
-            if not np.isnan(np.array(location)).any():
-
-                # get image
-                
-                image_html = self.get_image(row['photo_id'])
-                html = f"""
-                        <h4>Methane reading: {row['methane_level']} ppm </h4>
-                        <h4>Date/time recorded: {row['timestamp']} </h4>
-                        <h4>Infastructure type: {row['type_of_infrastructure']} </h4>
-                        <h4>Picture:</h4>
-                        {image_html}
-                        """
-                popup = folium.Popup(html)
-                #folium.Marker(location=[row['latitude'], row['longitude']], popup=popup).add_to(self.map)
-
-                # Add markers to specific layers based on your condition
-                if row['leak']: 
-                    folium.Marker(location=location, popup=popup).add_to(layer_nonzero)
-                else:
-                    folium.Marker(location=location, popup=popup).add_to(layer_zero)
-            else:
-                pass
+        # Build popup html for every point with vectorized string concatenation
+        img_html = df_valid['photo_id'].map(self.get_image)
+        popup_html = ('<h4>Methane reading: ' + df_valid['methane_level'].astype(str) + ' ppm </h4>'
+                      + '<h4>Date/time recorded: ' + df_valid['timestamp'].astype(str) + ' </h4>'
+                      + '<h4>Infastructure type: ' + df_valid['type_of_infrastructure'].astype(str) + ' </h4>'
+                      + '<h4>Picture:</h4>'
+                      + img_html)
+        popups = popup_html.to_numpy(dtype=object)
+
+        # Split points into leak / no leak
+        for layer, mask in ((layer_nonzero, leak), (layer_zero, ~leak)):
+            if not mask.any():
+                continue
+
+            # Markers are created in the browser, so no folium.Marker per point
+            data = [[lat, lon, html] for lat, lon, html in zip(lats[mask].tolist(),
+                                                               lons[mask].tolist(),
+                                                               popups[mask])]
+            FastMarkerCluster(data=data, callback=POPUP_MARKER_CALLBACK).add_to(layer)
 
         # Add the feature groups to the map
         layer_nonzero.add_to(self.map)
@@ -203,10 +410,41 @@ class leakMapper():
 
 
     
+    def get_cache_key(self):
+        """
+        Fingerprint the city's measurements and photos so an unchanged map isn't re-rendered.
+        """
+        self.connect()
+
+        # Hash the mapped rows themselves so in place edits are picked up
+        rows = pd.util.hash_pandas_object(self.read_measurements(), index=False).to_numpy()
+        rows_hash = hashlib.sha256(rows.tobytes()).hexdigest()
+        photo_count, photo_bytes = self.conn.execute(f"""
+                                                     SELECT COUNT(*), SUM(LENGTH(photo)) FROM photos
+                                                     WHERE photo_id IN (SELECT photo_id FROM {self.table} WHERE city = ?)
+                                                     """, (self.city,)).fetchone()
+        fingerprint = (f"{MAP_CACHE_VERSION}|{THUMBNAIL_SIZE}|{self.city}|{rows_hash}"
+                       f"|{photo_count}|{photo_bytes}|{self.embed_images}")
+        return hashlib.sha256(fingerprint.encode()).hexdigest()
+
     def execute(self):
+        key = self.get_cache_key()
+        photos_present = self.embed_images or os.path.isdir(self.photo_dir)
+        if os.path.exists(self.map_name) and os.path.exists(self.cache_path) and photos_present:
+            with open(self.cache_path) as f:
+                if f.read() == key:
+                    print(f"{self.map_name} is up to date.")
+                    self.close_connection()
+                    return
+
         self.set_df()
-        self.set_gdf()
+        if self.build_gdf:
+            self.set_gdf()
         self.plot_popups()
+        self.close_connection()
+
+        with open(self.cache_path, 'w') as f:
+            f.write(key)
 
         
 #####################################################################################################################
@@ -215,7 +453,12 @@ class leakMapper():
 
 def main():
 
-    mapper = leakMapper(PATH_TO_DB, TABLE_NAME)
+    parser = argparse.ArgumentParser(description='Maps methane leaks.')
+    parser.add_argument('city', help='City to map, as stored in the measurements table.')
+    parser.add_argument('--embed', action='store_true', help='Embed photos in the map html for offline use.')
+    args = parser.parse_args()
+
+    mapper = leakMapper(PATH_TO_DB, TABLE_NAME, args.city, embed_images=args.embed)
     mapper.execute()
 
 #####################################################################################################################